@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 from core.get_names import get_idol_names
 
 IDOL_NAMES = get_idol_names()
@@ -48,6 +50,25 @@ def parse_arguments(args: tuple, allow_unsupported_lists: bool = False) -> dict:
     """
     Parse all user arguments
 
+    :param args: Tuple of all arguments
+    :param allow_unsupported_lists: Whether parameters that School Idol
+        Tomodachi does not allow multiple values off are reduced.
+
+    :return: A list of tuples of (arg_type, arg_value)
+    """
+    parsed_args = _parse_arguments_cached(tuple(args), allow_unsupported_lists)
+
+    # Copy so callers can mutate their result without poisoning the cache.
+    return {arg_type: list(values) for arg_type, values in parsed_args.items()}
+
+
+@lru_cache(maxsize=256)
+def _parse_arguments_cached(args: tuple,
+                            allow_unsupported_lists: bool) -> dict:
+    """
+    Parse all user arguments, cached since identical argument tuples
+    repeat across command invocations.
+
     :param args: Tuple of all arguments
     :param allow_unsupported_lists: Whether parameters that School Idol
         Tomodachi does not allow multiple values off are reduced.
@@ -1,307 +1,456 @@
-from collections import namedtuple
-from posixpath import basename
-from random import randint, shuffle, uniform
-from time import time
-from copy import deepcopy
-from urllib.parse import urlsplit
-
-from discord import User
-
-from bot import SessionManager
-from core.argument_parser import parse_arguments
-from core.image_generator import create_image, get_one_img, \
-    idol_img_path
-
-RATES = {
-    "regular": {"N": 0.95, "R": 0.05, "SR": 0.00, "SSR": 0.00, "UR": 0.00},
-    "honour": {"N": 0.00, "R": 0.80, "SR": 0.15, "SSR": 0.04, "UR": 0.01},
-    "coupon": {"N": 0.00, "R": 0.00, "SR": 0.80, "SSR": 0.00, "UR": 0.20}
-}
-
-
-class ScoutImage(namedtuple('ScoutImage', ('bytes', 'name'))):
-    __slots__ = ()
-
-
-class ScoutHandler:
-    """
-    Provides scouting functionality for bot.
-    """
-    __slots__ = ('results', 'session_manager', '_user', '_box', '_count',
-                 '_guaranteed_sr', '_args')
-
-    def __init__(self, session_manager: SessionManager, user: User,
-                 box: str = "honour", count: int = 1,
-                 guaranteed_sr: bool = False, args: tuple = ()):
-        """
-        Constructor for a Scout.
-        :param session_manager: the SessionManager.
-        :param user: User requesting scout.
-        :param box: Box to scout in (honour, regular, coupon).
-        :param count: Number of cards in scout.
-        :param guaranteed_sr: Whether the scout will roll at least one SR.
-        :param args: Scout command arguments
-        """
-        self.results = []
-        self.session_manager = session_manager
-        self._user = user
-        self._box = box
-        self._count = count
-        self._guaranteed_sr = guaranteed_sr
-        self._args = parse_arguments(args)
-
-    async def do_scout(self):
-        if self._count > 1:
-            img = await self._handle_multiple_scout()
-        else:
-            img = await self._handle_solo_scout()
-        self.results = _shrink_results(self.results)
-        return img
-
-    async def _handle_multiple_scout(self):
-        """
-        Handles a scout with multiple cards
-
-        :return: Path of scout image
-        """
-        cards = await self._scout_cards()
-
-        if len(cards) != self._count:
-            self.results = []
-            return None
-
-        fname = f'{int(time())}{randint(0, 100)}.png'
-        _bytes = await create_image(self.session_manager, cards, 2)
-        return ScoutImage(_bytes, fname)
-
-    async def _handle_solo_scout(self):
-        """
-        Handles a solo scout
-
-        :return: Path of scout image
-        """
-        card = await self._scout_cards()
-
-        # Send error message if no card was returned
-        if not card:
-            self.results = []
-            return None
-
-        card = card[0]
-
-        if card["card_image"] is None:
-            url = "http:" + card["card_idolized_image"]
-        else:
-            url = "http:" + card["card_image"]
-
-        fname = basename(urlsplit(url).path)
-        image_path = idol_img_path.joinpath(fname)
-        bytes_ = await get_one_img(
-            url, image_path, self.session_manager)
-        return ScoutImage(bytes_, fname)
-
-    async def _scout_cards(self) -> list:
-        """
-        Scouts a specified number of cards
-
-        :return: cards scouted
-        """
-        rarities = []
-
-        if self._guaranteed_sr:
-            for r in range(self._count - 1):
-                rarities.append(self._roll_rarity())
-
-            if rarities.count("R") + rarities.count("N") == self._count - 1:
-                rarities.append(self._roll_rarity(True))
-            else:
-                rarities.append(self._roll_rarity())
-
-        # Case where a normal character is selected
-        elif (self._box == "regular") \
-                and len(self._args["name"]) > 0:
-            for r in range(self._count):
-                rarities.append("N")
-
-        else:
-            for r in range(self._count):
-                rarities.append(self._roll_rarity())
-
-        results = []
-
-        for rarity in RATES[self._box].keys():
-            if rarities.count(rarity) > 0:
-                scout = await self._scout_request(
-                    rarities.count(rarity), rarity
-                )
-
-                results += _get_adjusted_scout(
-                    scout, rarities.count(rarity)
-                )
-
-        self.results = results
-        shuffle(results)
-        return results
-
-    async def _scout_request(self, count: int, rarity: str) -> dict:
-        """
-        Scouts a specified number of cards of a given rarity
-
-        :param rarity: Rarity of all cards in scout
-
-        :return: Cards scouted
-        """
-        if count == 0:
-            return {}
-        params = {
-            'rarity': rarity,
-            'ordering': 'random',
-            'is_promo': 'False',
-            'is_special': 'False',
-            'page_size': str(count)
-        }
-        url = 'http://schoolido.lu/api/cards/?'
-
-        for arg_type, arg_values in self._args.items():
-            if not arg_values:
-                continue
-
-            values_str = ",".join(arg_values)
-            values_str = values_str.replace(" ", "%20")
-
-            if arg_type == "main_unit":
-                values_str = values_str.replace("Muse", "µ's")
-                params['idol_main_unit'] = values_str
-            elif arg_type == "sub_unit":
-                params['idol_sub_unit'] = values_str
-            elif arg_type == "name":
-                url += "&name=" + values_str
-            # FIXME Why the heck does this not work.
-            # elif arg_type == "name":
-            #     params['name'] = values_str
-            elif arg_type == "year":
-                params['idol_year'] = values_str
-            elif arg_type == "attribute":
-                params['attribute'] = values_str
-
-        # Get and return response
-        return await self.session_manager.get_json(url, params)
-
-    def _roll_rarity(self, guaranteed_sr: bool = False) -> str:
-        """
-        Generates a random rarity based on the defined scouting rates
-
-        :param guaranteed_sr: Whether roll should be an SR
-
-        :return: rarity represented as a string ('UR', 'SSR', 'SR', 'R')
-        """
-        roll = uniform(0, 1)
-
-        required_roll = RATES[self._box]['UR']
-        if roll < required_roll:
-            return 'UR'
-
-        required_roll = RATES[self._box]['SSR'] + RATES[self._box]['UR']
-        if roll < required_roll:
-            return 'SSR'
-
-        required_roll = RATES[self._box]['SR'] + RATES[self._box]['SSR']
-        required_roll += RATES[self._box]['UR']
-        if roll < required_roll:
-            return 'SR'
-
-        required_roll = RATES[self._box]['R'] + RATES[self._box]['SR']
-        required_roll += RATES[self._box]['SSR'] + RATES[self._box]['UR']
-        if roll < required_roll:
-            if guaranteed_sr:
-                return 'SR'
-            else:
-                return 'R'
-        else:
-            return 'N'
-
-
-def _get_adjusted_scout(scout: dict, required_count: int) -> list:
-    """
-    Adjusts a pull of a single rarity by checking if a card should flip to
-    a similar one and by duplicating random cards in the scout if there were
-    not enough scouted.
-
-    :param scout: Dictionary representing the scout.
-        All these cards will have the same rarity.
-
-    :param required_count: The number of cards that need to be scouted.
-
-    :return: Adjusted list of cards scouted
-    """
-    # Add missing cards to scout by duplicating random cards already present
-    current_count = len(scout['results'])
-
-    # Something bad happened, return an empty list
-    if current_count == 0:
-        return []
-
-    while current_count < required_count:
-        scout['results'].append(
-            scout['results'][randint(0, current_count - 1)]
-        )
-        current_count += 1
-
-    # Traverse scout and roll for flips
-    for card_index in range(len(scout['results']) - 1):
-        # for each card there is a (1 / total cards)
-        # chance that we should dupe
-        # the previous card
-        roll = uniform(0, 1)
-        if roll < 1 / scout['count']:
-            scout['results'][card_index] = scout['results'][card_index + 1]
-
-    return scout['results']
-
-
-def _shrink_results(results: list):
-    """
-    Removed uneeded information from scout results.
-
-    :param results: Scout results being shrunk.
-    """
-    if not results:
-        return
-
-    results_copy = []
-    for res in results:
-        results_copy.append(deepcopy(res))
-    results = results_copy
-
-    keep_fields = {
-        "id",
-        "name",
-        "year",
-        "main_unit",
-        "sub_unit",
-        "rarity",
-        "attribute",
-        "release_date",
-        "round_card_image",
-        "round_card_idolized_image"
-    }
-    res = []
-    for result in results:
-        # Copy needed fields under idol
-        result["name"] = result["idol"]["name"]
-        result["year"] = result["idol"]["year"]
-        result["main_unit"] = result["idol"]["main_unit"]
-        result["sub_unit"] = result["idol"]["sub_unit"]
-
-        # Delete uneeded fields
-        delete_fields = []
-        for field in result:
-            if field not in keep_fields:
-                delete_fields.append(field)
-        for field in delete_fields:
-            result.pop(field, None)
-
-        # Replace None with empty string for sorting purposes.
-        replaced = {key: (val or '') for key, val in result.items()}
-        res.append(replaced)
-    return res
+from asyncio import gather
+from collections import Counter, OrderedDict, namedtuple
+from itertools import accumulate
+from random import choices, random, randrange, sample
+from secrets import token_hex
+from time import time
+
+from discord import User
+
+# Optional; only used to vectorize sampling for very large scouts.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from bot import SessionManager
+from core.argument_parser import parse_arguments
+from core.image_generator import create_image, get_one_img, \
+    idol_img_path
+
+RATES = {
+    "regular": {"N": 0.95, "R": 0.05, "SR": 0.00, "SSR": 0.00, "UR": 0.00},
+    "honour": {"N": 0.00, "R": 0.80, "SR": 0.15, "SSR": 0.04, "UR": 0.01},
+    "coupon": {"N": 0.00, "R": 0.00, "SR": 0.80, "SSR": 0.00, "UR": 0.20}
+}
+
+# Fixed rarity ordering used to build the cumulative distributions below.
+RARITIES = ("UR", "SSR", "SR", "R", "N")
+
+# Card pools cached per (rarity, filters) so repeated scouts with the
+# same filters skip the network; the catalog is effectively static but
+# which cards a scout rolls is not, so each scout samples its cards
+# client side from the cached pool. Entries are (fetch_time, response)
+# pairs, kept in least-recently-used order and bounded since keys embed
+# user-supplied filters.
+_CARD_CACHE = OrderedDict()
+_CARD_CACHE_TTL = 3600
+_CARD_CACHE_MAX_SIZE = 128
+_CARD_POOL_SIZE = 100
+
+# Card API query parameter for each scout argument type. The name
+# argument is absent because it only works appended to the url string.
+_ARG_TO_PARAM = {
+    "main_unit": "idol_main_unit",
+    "sub_unit": "idol_sub_unit",
+    "year": "idol_year",
+    "attribute": "attribute"
+}
+
+
+def _build_cdf(rates: dict) -> tuple:
+    """
+    Builds a cumulative distribution over RARITIES for a box's rates.
+
+    :param rates: Rarity to probability mapping for a box.
+
+    :return: Tuple of cumulative thresholds parallel to RARITIES.
+    """
+    return tuple(accumulate(rates[rarity] for rarity in RARITIES))
+
+
+def _guaranteed_sr_rates(rates: dict) -> dict:
+    """
+    Folds a box's R and N weights into SR, for rolls that must produce
+    at least an SR.
+
+    :param rates: Rarity to probability mapping for a box.
+
+    :return: Rarity to probability mapping with R and N folded into SR.
+    """
+    return {
+        "UR": rates["UR"],
+        "SSR": rates["SSR"],
+        "SR": rates["SR"] + rates["R"] + rates["N"],
+        "R": 0.0,
+        "N": 0.0
+    }
+
+
+def _build_alias_table(rates: dict) -> tuple:
+    """
+    Builds a Walker alias table over RARITIES for a box's rates using
+    Vose's algorithm, so a single roll is O(1): one random index, one
+    random float and at most one table redirect.
+
+    :param rates: Rarity to probability mapping for a box.
+
+    :return: Tuple of (probability table, alias table) parallel to
+        RARITIES.
+    """
+    n = len(RARITIES)
+    scaled = [rates[rarity] * n for rarity in RARITIES]
+    prob = [1.0] * n
+    alias = list(range(n))
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1.0 - scaled[s]
+        if scaled[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+
+    return tuple(prob), tuple(alias)
+
+
+# Cumulative distributions precomputed per box, used by the batched
+# random.choices sampling in _scout_cards.
+_CDF = {box: _build_cdf(rates) for box, rates in RATES.items()}
+
+# Scout size from which the numpy round trip beats random.choices.
+_NUMPY_MIN_COUNT = 100
+_CDF_NUMPY = (
+    {box: numpy.asarray(cdf) for box, cdf in _CDF.items()}
+    if numpy is not None else {}
+)
+
+# Alias tables precomputed per box for single rolls, plus variants with
+# the R and N weights folded into SR for guaranteed rolls.
+_ALIAS = {box: _build_alias_table(rates) for box, rates in RATES.items()}
+_GUARANTEED_SR_ALIAS = {
+    box: _build_alias_table(_guaranteed_sr_rates(rates))
+    for box, rates in RATES.items()
+}
+
+
+ScoutImage = namedtuple('ScoutImage', ('bytes', 'name'))
+
+
+class ScoutHandler:
+    """
+    Provides scouting functionality for bot.
+    """
+    __slots__ = ('results', 'session_manager', '_user', '_box', '_count',
+                 '_guaranteed_sr', '_args', '_cdf', '_alias',
+                 '_guaranteed_sr_alias', '_base_params', '_name_query',
+                 '_cache_key_args')
+
+    def __init__(self, session_manager: SessionManager, user: User,
+                 box: str = "honour", count: int = 1,
+                 guaranteed_sr: bool = False, args: tuple = ()):
+        """
+        Constructor for a Scout.
+        :param session_manager: the SessionManager.
+        :param user: User requesting scout.
+        :param box: Box to scout in (honour, regular, coupon).
+        :param count: Number of cards in scout.
+        :param guaranteed_sr: Whether the scout will roll at least one SR.
+        :param args: Scout command arguments
+        """
+        self.results = []
+        self.session_manager = session_manager
+        self._user = user
+        self._box = box
+        self._count = count
+        self._guaranteed_sr = guaranteed_sr
+        self._args = parse_arguments(args)
+        self._cdf = _CDF[box]
+        self._alias = _ALIAS[box]
+        self._guaranteed_sr_alias = _GUARANTEED_SR_ALIAS[box]
+        self._base_params, self._name_query = _build_query_args(self._args)
+        self._cache_key_args = (self._name_query,
+                                tuple(sorted(self._base_params.items())))
+
+    async def do_scout(self):
+        if self._count > 1:
+            img, cards = await self._handle_multiple_scout()
+        else:
+            img, cards = await self._handle_solo_scout()
+        self.results = list(_shrink_results(cards))
+        return img
+
+    async def _handle_multiple_scout(self):
+        """
+        Handles a scout with multiple cards
+
+        :return: Tuple of (scout image, cards scouted)
+        """
+        cards = await self._scout_cards()
+
+        if len(cards) != self._count:
+            return None, []
+
+        fname = f'{token_hex(8)}.png'
+        _bytes = await create_image(self.session_manager, cards, 2)
+        return ScoutImage(_bytes, fname), cards
+
+    async def _handle_solo_scout(self):
+        """
+        Handles a solo scout
+
+        :return: Tuple of (scout image, cards scouted)
+        """
+        cards = await self._scout_cards()
+
+        # Send error message if no card was returned
+        if not cards:
+            return None, []
+
+        card = cards[0]
+
+        if card["card_image"] is None:
+            url = "http:" + card["card_idolized_image"]
+        else:
+            url = "http:" + card["card_image"]
+
+        fname = url.rpartition('/')[2].partition('?')[0]
+        image_path = idol_img_path.joinpath(fname)
+        bytes_ = await get_one_img(
+            url, image_path, self.session_manager)
+        return ScoutImage(bytes_, fname), cards
+
+    async def _scout_cards(self) -> list:
+        """
+        Scouts a specified number of cards
+
+        :return: cards scouted
+        """
+        if self._guaranteed_sr:
+            rarities = self._sample_rarities(self._count - 1)
+
+            if set(rarities) <= {"R", "N"}:
+                rarities.append(self._roll_rarity(True))
+            else:
+                rarities.append(self._roll_rarity())
+
+        # Case where a normal character is selected
+        elif (self._box == "regular") \
+                and len(self._args["name"]) > 0:
+            rarities = ["N"] * self._count
+
+        else:
+            rarities = self._sample_rarities(self._count)
+
+        counts = Counter(rarities)
+        pairs = [
+            (rarity, counts[rarity]) for rarity in RARITIES if counts[rarity]
+        ]
+
+        # Fire the per-rarity requests concurrently so the scout pays the
+        # latency of the slowest request rather than the sum of all of them.
+        scouts = await gather(
+            *(self._scout_request(count, rarity) for rarity, count in pairs)
+        )
+
+        results = []
+        for (rarity, count), scout in zip(pairs, scouts):
+            results.extend(_get_adjusted_scout(scout, count))
+
+        return results
+
+    async def _scout_request(self, count: int, rarity: str) -> dict:
+        """
+        Scouts a specified number of cards of a given rarity
+
+        :param rarity: Rarity of all cards in scout
+
+        :return: Cards scouted
+        """
+        if count == 0:
+            return {}
+
+        pool = await self._request_card_pool(rarity)
+        results = pool['results']
+
+        # Sample client side so scouts served from a cached pool still
+        # roll fresh cards instead of replaying the server's ordering.
+        if count < len(results):
+            results = sample(results, count)
+        else:
+            results = list(results)
+        return {'count': pool['count'], 'results': results}
+
+    async def _request_card_pool(self, rarity: str) -> dict:
+        """
+        Fetches the pool of cards matching the scout's filters for a
+        given rarity, reusing a cached pool when one is fresh.
+
+        :param rarity: Rarity of all cards in the pool
+
+        :return: Card API response for the pool
+        """
+        key = (rarity,) + self._cache_key_args
+        cached = _CARD_CACHE.get(key)
+        if cached is not None:
+            if time() - cached[0] < _CARD_CACHE_TTL:
+                _CARD_CACHE.move_to_end(key)
+                return cached[1]
+            del _CARD_CACHE[key]
+
+        params = {
+            'rarity': rarity,
+            'ordering': 'random',
+            'is_promo': 'False',
+            'is_special': 'False',
+            'page_size': str(_CARD_POOL_SIZE)
+        }
+        if self._base_params:
+            params.update(self._base_params)
+        url = 'http://schoolido.lu/api/cards/?' + self._name_query
+
+        # Get, cache and return response
+        response = await self.session_manager.get_json(url, params)
+        _CARD_CACHE[key] = (time(), response)
+        if len(_CARD_CACHE) > _CARD_CACHE_MAX_SIZE:
+            _CARD_CACHE.popitem(last=False)
+        return response
+
+    def _sample_rarities(self, count: int) -> list:
+        """
+        Draws a batch of random rarities based on the defined scouting
+        rates, vectorized through numpy when it is available and the
+        batch is large enough to amortize the array round trip.
+
+        :param count: Number of rarities to draw.
+
+        :return: List of rarities drawn.
+        """
+        if numpy is not None and count >= _NUMPY_MIN_COUNT:
+            indices = numpy.searchsorted(
+                _CDF_NUMPY[self._box], numpy.random.random(count),
+                side='right'
+            )
+            return [RARITIES[i] for i in indices]
+        return choices(RARITIES, cum_weights=self._cdf, k=count)
+
+    def _roll_rarity(self, guaranteed_sr: bool = False) -> str:
+        """
+        Generates a random rarity based on the defined scouting rates
+
+        :param guaranteed_sr: Whether roll should be an SR
+
+        :return: rarity represented as a string ('UR', 'SSR', 'SR', 'R')
+        """
+        if guaranteed_sr:
+            prob, alias = self._guaranteed_sr_alias
+        else:
+            prob, alias = self._alias
+        index = randrange(len(RARITIES))
+        if random() >= prob[index]:
+            index = alias[index]
+        return RARITIES[index]
+
+
+def _build_query_args(args: dict) -> tuple:
+    """
+    Builds the card API query pieces for a set of parsed scout arguments.
+    Done once per handler so each per-rarity request only merges dicts.
+
+    :param args: Parsed scout arguments.
+
+    :return: Tuple of (base query params, name query url string)
+    """
+    params = {}
+    name_query = ''
+
+    for arg_type, arg_values in args.items():
+        if not arg_values:
+            continue
+
+        values_str = ",".join(arg_values)
+        values_str = values_str.replace(" ", "%20")
+
+        if arg_type == "name":
+            name_query = "&name=" + values_str
+            continue
+        # FIXME Why the heck does this not work.
+        # if arg_type == "name":
+        #     params['name'] = values_str
+
+        param = _ARG_TO_PARAM.get(arg_type)
+        if param is None:
+            continue
+        if arg_type == "main_unit":
+            values_str = values_str.replace("Muse", "µ's")
+        params[param] = values_str
+
+    return params, name_query
+
+
+def _get_adjusted_scout(scout: dict, required_count: int) -> list:
+    """
+    Adjusts a pull of a single rarity by checking if a card should flip to
+    a similar one and by duplicating random cards in the scout if there were
+    not enough scouted.
+
+    :param scout: Dictionary representing the scout.
+        All these cards will have the same rarity.
+
+    :param required_count: The number of cards that need to be scouted.
+
+    :return: Adjusted list of cards scouted
+    """
+    # Add missing cards to scout by duplicating random cards already present
+    current_count = len(scout['results'])
+
+    # Something bad happened, return an empty list
+    if current_count == 0:
+        return []
+
+    missing = required_count - current_count
+    if missing > 0:
+        scout['results'].extend(choices(scout['results'], k=missing))
+
+    # Traverse scout and roll for flips
+    results = scout['results']
+    flip_chance = 1 / scout['count']
+    for card_index in range(len(results) - 1):
+        # for each card there is a (1 / total cards)
+        # chance that we should dupe
+        # the previous card
+        if random() < flip_chance:
+            results[card_index] = results[card_index + 1]
+
+    return results
+
+
+def _shrink_results(results: list):
+    """
+    Removed uneeded information from scout results.
+
+    :param results: Scout results being shrunk.
+
+    :return: Generator of shrunk results.
+    """
+    keep_fields = {
+        "id",
+        "name",
+        "year",
+        "main_unit",
+        "sub_unit",
+        "rarity",
+        "attribute",
+        "release_date",
+        "round_card_image",
+        "round_card_idolized_image"
+    }
+    for result in results:
+        # Build a new dict with only the needed fields, copying the
+        # idol's fields up to the top level.
+        idol = result["idol"]
+        shrunk = {
+            key: val for key, val in result.items() if key in keep_fields
+        }
+        shrunk["name"] = idol["name"]
+        shrunk["year"] = idol["year"]
+        shrunk["main_unit"] = idol["main_unit"]
+        shrunk["sub_unit"] = idol["sub_unit"]
+
+        # Replace None with empty string for sorting purposes.
+        yield {key: (val or '') for key, val in shrunk.items()}